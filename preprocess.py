@@ -5,14 +5,132 @@ industrial census data.
 Notice:
     1. only three columns were extracted in current version.
     2. current version only support data in ROC year 85, 90, and 95 (1996, 2001, 2006)
+    3. the collected data are cached as "{year}_cache.parquet", run with --rebuild to
+       collect from the raw files again.
 
 Author: KYK
 Date: Jun.24.2024
 '''
 
+import argparse
+import json
+import numpy as np
 import pandas as pd
-from os import listdir, getcwd
-from os.path import isfile, join
+import pyarrow as pa
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from mmap import mmap, ACCESS_READ
+from numba import njit, prange, set_num_threads
+from os import listdir, getcwd, cpu_count, stat
+from os.path import isfile, join, getsize, exists, realpath
+
+# the sign and the last digit that each zd code stands for, see Processor.__zd_convertor
+ZD_MAP = {
+    "{": [1, 0], "}": [-1, 0],
+    "A": [1, 1], "J": [-1, 1],
+    "B": [1, 2], "K": [-1, 2],
+    "C": [1, 3], "L": [-1, 3],
+    "D": [1, 4], "M": [-1, 4],
+    "E": [1, 5], "N": [-1, 5],
+    "F": [1, 6], "O": [-1, 6],
+    "G": [1, 7], "P": [-1, 7],
+    "H": [1, 8], "Q": [-1, 8],
+    "I": [1, 9], "R": [-1, 9]
+}
+
+# lookup tables indexed by the byte value of the zd code, so the mapping can be
+# done on the whole column at once instead of looking up the dict row by row.
+# the sign of the bytes not in ZD_MAP is 0, which marks them as not a zd code.
+SIGN_LUT = np.zeros(256, dtype=np.int8)
+VALUE_LUT = np.zeros(256, dtype=np.int8)
+for code, (sign, value) in ZD_MAP.items():
+    SIGN_LUT[ord(code)] = sign
+    VALUE_LUT[ord(code)] = value
+
+
+# the key in the parquet cache metadata of the source files the cache was collected from
+CACHE_SOURCE_KEY = b"census_source"
+
+# the extracted columns and their dtype when collected, see Processor._extract
+COLUMNS = {'scale': 'S1', 'primary': 'S4', 'roc_sic': 'S2', 'asset': np.int64}
+
+
+@njit(parallel=True, cache=True)
+def _parse_numbers(digits, zd, sign_lut, value_lut, out):
+    '''
+    Turn fixed-width ascii numbers into integers, one record per loop in parallel.
+    Each number may have leading and trailing spaces, and (if not zd) a leading "+" or "-",
+    the same as what int() accepts. If zd is True the last character is taken as the zd
+    code (see Processor.__zd_convertor), decoded by the lookup tables, and a code
+    not in the tables makes the number not valid.
+
+    Parameters
+    ----------
+    digits: np.ndarray
+        a 2-D uint8 array, each row is the ascii characters of a number.
+    zd: bool
+        whether the numbers are in the zd format.
+    sign_lut, value_lut: np.ndarray
+        SIGN_LUT and VALUE_LUT.
+    out: np.ndarray
+        the 1-D int64 array to write the numbers into, one element per row of digits.
+
+    Return
+    ------
+        the number of rows that are not valid numbers, their elements in out are set to 0.
+    '''
+    n, width = digits.shape
+    n_digits = width - 1 if zd else width
+    n_bad = 0
+
+    for i in prange(n):
+        j = 0
+        while j < n_digits and digits[i, j] == 32: # leading spaces
+            j += 1
+
+        neg = False
+        if not zd and j < n_digits and (digits[i, j] == 43 or digits[i, j] == 45): # "+" or "-"
+            neg = digits[i, j] == 45
+            j += 1
+
+        v = 0
+        start = j
+        while j < n_digits and 48 <= digits[i, j] <= 57:
+            v = v * 10 + (digits[i, j] - 48)
+            j += 1
+        valid = j > start
+
+        while j < n_digits and digits[i, j] == 32: # trailing spaces
+            j += 1
+        # anything else left is not part of a number
+        valid = valid and j == n_digits
+
+        if zd:
+            c = digits[i, n_digits]
+            v = (v * 10 + value_lut[c]) * sign_lut[c]
+            valid = valid and sign_lut[c] != 0
+        elif neg:
+            v = -v
+
+        if valid:
+            out[i] = v
+        else:
+            out[i] = 0
+            n_bad += 1
+
+    return n_bad
+
+
+@lru_cache(maxsize=1)
+def _load_sic_table() -> pd.DataFrame:
+    '''
+    Read the ISIC and ROCSIC mapping table. Reading excel is slow, so the table is
+    read only once and shared by all the Processors (please do not modify it).
+    '''
+    return pd.read_excel("ISIC_to_ROCSIC.xlsx", sheet_name="Sheet2")
+
 
 class Processor():
     def __init__(self, upperlayer_folder="", folder="") -> None:
@@ -20,6 +138,8 @@ class Processor():
         self.folder = folder
         self._extracted = False
         self.__data = None
+        self.__mask = None # rows kept by apply_conditions, None means all.
+        self.__source = None # source files of a single fresh collection, see __source_of
         self.__warn_data_not_collected = "Not yet processed, please collect the data first."
     
     def __slash_maker(self):
@@ -36,7 +156,26 @@ class Processor():
 
         return "\\" + uf + "\\" + f + "\\"
     
-    def __zd_convertor(self, zd_format_series: pd.Series) -> pd.Series:
+    @staticmethod
+    def __digits_to_int(digits: np.ndarray, out: np.ndarray) -> None:
+        '''
+        Turn fixed-width ascii digits into integers without parsing them one by one.
+        Each row is taken as the digits of one number, which can be padded with spaces
+        and have a sign in front (see _parse_numbers).
+
+        Parameters
+        ----------
+        digits: np.ndarray
+            a 2-D uint8 array, each row is the ascii digits of a number.
+        out: np.ndarray
+            the 1-D int64 array to write the numbers into.
+        '''
+        n_bad = _parse_numbers(digits, False, SIGN_LUT, VALUE_LUT, out)
+        if n_bad:
+            raise ValueError(f"{n_bad} record(s) do not have a valid number.")
+
+    @staticmethod
+    def __zd_convertor(zd_format: np.ndarray, out: np.ndarray) -> None:
         '''
         This zd format stands for zoned decimal format, developed by IBM.
         suggested reference: http://www.simotime.com/datazd01.htm
@@ -47,38 +186,119 @@ class Processor():
         
         Parameters
         ----------
-        zd_format_series: pd.Series
-            a series of numbers that is in the zd format.
-        
-        Return
-        ------
-            a series of numbers in the format we normally use.
-        '''
-        zd_map = {
-            "{": [1, 0], "}": [-1, 0],
-            "A": [1, 1], "J": [-1, 1],
-            "B": [1, 2], "K": [-1, 2],
-            "C": [1, 3], "L": [-1, 3],
-            "D": [1, 4], "M": [-1, 4],
-            "E": [1, 5], "N": [-1, 5],
-            "F": [1, 6], "O": [-1, 6],
-            "G": [1, 7], "P": [-1, 7],
-            "H": [1, 8], "Q": [-1, 8],
-            "I": [1, 9], "R": [-1, 9]
-        }
+        zd_format: np.ndarray
+            a 2-D uint8 array, each row is the ascii characters of a number in the zd format.
+        out: np.ndarray
+            the 1-D int64 array to write the numbers in the format we normally use into.
+        '''
+        # the codes are already byte values, the kernel simply looks up the sign and value tables
+        n_bad = _parse_numbers(zd_format, True, SIGN_LUT, VALUE_LUT, out)
+        if n_bad:
+            raise ValueError(f"{n_bad} record(s) do not have a valid number in the zd format.")
 
-        n = len(zd_format_series[0])
+    @staticmethod
+    def __field(buf: np.ndarray, start: int, stop: int, out: np.ndarray) -> None:
+        '''
+        Copy a fixed-width column [start, stop) of the records into out.
 
-        front_digits = zd_format_series.str.slice(stop=n-1).astype('int64') * 10
-        zd_code = zd_format_series.str.slice(start=n-1)
-        zdc_mapped = zd_code.map(zd_map)
+        Parameters
+        ----------
+        buf: np.ndarray
+            the records viewed as a 2-D uint8 array, one row per company.
+        start, stop: int
+            the position of the column in each record.
+        out: np.ndarray
+            the array of bytes strings (dtype S{stop-start}) to write into, one per company.
+        '''
+        out.view(np.uint8).reshape(len(out), stop - start)[:] = buf[:, start:stop]
 
-        # split the mapped thing
-        tmp_df = pd.DataFrame(zdc_mapped.to_list(), columns=['sign','value'])
+    @staticmethod
+    def __to_text(field: np.ndarray) -> pd.Series:
+        '''
+        Decode a collected column of bytes strings into a series of strings.
+        The strings are stored in pyarrow, as a contiguous buffer rather than an object per company,
+        and the pyarrow array is simply made on top of the bytes, without a python string per company.
+        There are some bytes not encoded as ascii, those are ignored. And the trailing null bytes
+        are taken as padding and removed, as numpy does for bytes strings.
+        '''
+        data = field.view(np.uint8).reshape(len(field), field.dtype.itemsize)
+        is_ascii = data < 128
+        # a null byte is padding if all the bytes after it are null (or ignored) as well
+        is_padding = np.logical_and.accumulate(((data == 0) | ~is_ascii)[:, ::-1], axis=1)[:, ::-1]
+        keep = is_ascii & ~is_padding
+
+        if keep.all():
+            # the bytes are already valid strings of the same width
+            values = data.ravel()
+            offsets = np.arange(0, data.size + 1, data.shape[1], dtype=np.int32)
+        else:
+            # drop the non-ascii and padding bytes, each string then ends where its kept bytes end
+            values = data[keep]
+            offsets = np.zeros(len(field) + 1, dtype=np.int32)
+            np.cumsum(keep.sum(axis=1), out=offsets[1:])
+
+        arr = pa.Array.from_buffers(pa.string(), len(field), [None, pa.py_buffer(offsets), pa.py_buffer(values)])
+        return pd.Series(pd.arrays.ArrowStringArray(arr))
+
+    @staticmethod
+    def __to_category(field: np.ndarray) -> pd.Categorical:
+        '''
+        Same as __to_text, but for the columns with only a few distinct values, which are
+        stored as category, i.e. a small int code per company.
+        '''
+        return pd.Categorical(Processor.__to_text(field))
 
-        return (front_digits + tmp_df['value']) * tmp_df['sign']
+    @staticmethod
+    def __record_length(raw: mmap) -> int:
+        '''
+        Every company is a fixed-width record ended with "\\r\\n" (including the last one),
+        so the record length (including "\\r\\n") is given by the first "\\r\\n".
+        '''
+        reclen = raw.find(b"\r\n") + 2
+        if reclen < 2:
+            raise ValueError("No record ended with \"\\r\\n\" is found in the file.")
+
+        return reclen
+
+    @staticmethod
+    def __n_records(file_path: str) -> int:
+        '''
+        Count the companies in a file without reading all of it in, by the length
+        of the first record (see __records).
+        '''
+        size = getsize(file_path)
+        if not size:
+            return 0
+
+        with open(file_path, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+            return size // Processor.__record_length(mm)
+
+    @staticmethod
+    def __records(raw: mmap) -> np.ndarray:
+        '''
+        View the raw data of a file as a 2-D array, one row per company (see __record_length),
+        no copy is made.
+
+        Parameters
+        ----------
+        raw: mmap
+            the raw data of the file, memory-mapped (or bytes read straight from the file).
+
+        Return
+        ------
+            a 2-D uint8 array of shape (number of companies, record length without "\\r\\n").
+        '''
+        reclen = Processor.__record_length(raw)
+        n = len(raw) // reclen
+        buf = np.frombuffer(raw, dtype=np.uint8)[:n*reclen].reshape(n, reclen)
 
-    def _extract(self, company_list: list) -> pd.DataFrame:
+        if len(raw) % reclen or not ((buf[:, -2] == ord("\r")) & (buf[:, -1] == ord("\n"))).all():
+            raise ValueError("The records in the file are not of the same length.")
+
+        return buf[:, :-2]
+
+    @staticmethod
+    def _extract(buf: np.ndarray, year: str, out: dict) -> None:
         '''
         The following are the column names and their position stated in the code.doc.
         (Our target columns in files "a" to "f" in year 85 and 90 share the same position and length.)
@@ -88,38 +308,136 @@ class Processor():
         x3613 (1139-1153) | x360013 (1069-1083) | x360019 (246-260)
         -----
         Parameters
-        company_list: list. 
-            the raw data read straight from the file, each element represents a company.
-            and each element is a long string of info of the company.
+        buf: np.ndarray
+            the records of a file as a 2-D uint8 array (see __records), each row represents
+            a company and is a fixed-width long string of info of the company.
+        year: str
+            the ROC year of the data, i.e. "85", "90" or "95".
+        out: dict
+            the arrays of each column in COLUMNS to write the extracted and processed
+            data into, each of the same length as buf.
+        '''
+        # primary_short is the first 2 digits of primary, cut it from the records as well
+        # rather than slicing the strings of primary once more.
+        if year == "85":
+            Processor.__field(buf, 7, 8, out['scale'])
+            Processor.__field(buf, 13, 17, out['primary'])
+            Processor.__field(buf, 13, 15, out['roc_sic'])
+            Processor.__zd_convertor(buf[:, 1138:1153], out['asset'])
+        elif year == "90":
+            Processor.__field(buf, 11, 12, out['scale'])
+            Processor.__field(buf, 13, 17, out['primary'])
+            Processor.__field(buf, 13, 15, out['roc_sic'])
+            Processor.__digits_to_int(buf[:, 1068:1083], out['asset'])
+        elif year == "95":
+            Processor.__field(buf, 1, 2, out['scale'])
+            Processor.__field(buf, 2, 6, out['primary'])
+            Processor.__field(buf, 2, 4, out['roc_sic'])
+            Processor.__zd_convertor(buf[:, 245:260], out['asset'])
+
+    @staticmethod
+    def _parse_file(file_path: str, year: str, n: int) -> dict:
+        '''
+        Extract the designated columns of a file, this is run in the worker processes.
 
+        Parameters
+        ----------
+        file_path: str
+            the path of the file.
+        year: str
+            the ROC year of the data, i.e. "85", "90" or "95".
+        n: int
+            the number of companies in the file (see __n_records).
+
+        Return
+        ------
+            the arrays of each column in COLUMNS, of length n.
+        '''
+        out = {col: np.empty(n, dtype=dtype) for col, dtype in COLUMNS.items()}
+
+        if n:
+            error = None
+            # map the file instead of reading it in, so the page cache is the only copy.
+            # _extract copies the columns out, so no view of the file is kept after closing.
+            with open(file_path, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+                buf = None
+                try:
+                    # every record has the same length, so each column is simply a slice of them.
+                    buf = Processor.__records(mm)
+                    if len(buf) != n:
+                        raise ValueError(f"{len(buf)} records are found, but {n} were counted.")
+                    Processor._extract(buf, year, out)
+                except ValueError as e:
+                    # the traceback still holds the views of the file, which stops the mmap
+                    # from closing, so drop it and raise after the file is closed.
+                    error = ValueError(f'File "{file_path}": {e}')
+                finally:
+                    buf = None
+
+            if error is not None:
+                raise error
+
+        return out
+
+    def __cache_path(self) -> str:
+        '''
         Return
         ------
-            a dataframe with extracted and processed data of designated columns.
+            the path of the parquet cache of the collected and mapped data of the folder.
         '''
-        comps = pd.Series(company_list)
+        return f'{self.folder[:3]}_cache.parquet'
 
-        if self.folder[:2] == "85":
-            scale = comps.str.slice(start=7, stop=8)
-            primary = comps.str.slice(start=13, stop=17)
-            primary_short = primary.str.slice(start=0, stop=2)
-            asset = self.__zd_convertor(comps.str.slice(start=1138, stop=1153))
-        elif self.folder[:2] == "90":
-            scale = comps.str.slice(start=11, stop=12)
-            primary = comps.str.slice(start=13, stop=17)
-            primary_short = primary.str.slice(start=0, stop=2)
-            asset = comps.str.slice(start=1068, stop=1083).astype('int64')
-        elif self.folder[:2] == "95":
-            scale = comps.str.slice(start=1, stop=2)
-            primary = comps.str.slice(start=2, stop=6)
-            primary_short = primary.str.slice(start=0, stop=2)
-            asset = self.__zd_convertor(comps.str.slice(start=245, stop=260))
+    @staticmethod
+    def __source_of(path: str, target_files: list) -> str:
+        '''
+        Describe the source files of a collection, i.e. the folder and the name, size and
+        modified time of each file. The cache is only used if it was collected from the same.
+        '''
+        files = []
+        for f in sorted(target_files):
+            st = stat(join(path, f))
+            files.append([f, st.st_size, st.st_mtime_ns])
+
+        return json.dumps({'folder': realpath(path), 'files': files})
+
+    def __read_cache(self, source: str) -> bool:
+        '''
+        Read the data from the parquet cache, if it exists and was collected from source.
+
+        Return
+        ------
+            whether the data are read from the cache.
+        '''
+        cache = self.__cache_path()
+        if not exists(cache):
+            return False
+
+        metadata = pq.read_schema(cache).metadata or {}
+        if metadata.get(CACHE_SOURCE_KEY) != source.encode():
+            print(f'\nThe source files were changed since "{cache}" was saved, collect them again.')
+            return False
+
+        self.__data = pd.read_parquet(cache)
+        # the categories come back as they are, but the strings as python strings
+        self.__data['primary'] = self.__data['primary'].astype('string[pyarrow]')
+        print(f'\nData of folder "{self.folder}" is read from "{cache}".')
 
-        # concat with axis=1 means each series will turn into a column
-        return pd.concat([scale, primary, primary_short, asset], axis=1).reset_index(drop=True)
+        return True
 
-    def collect_data(self) -> None:
+    def __write_cache(self) -> None:
+        '''
+        Save the data as the parquet cache, with the source files they were collected from.
+        '''
+        table = pa.Table.from_pandas(self.__data, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), CACHE_SOURCE_KEY: self.__source.encode()})
+        pq.write_table(table, self.__cache_path(), compression='zstd')
+
+    def collect_data(self, rebuild=False) -> None:
         '''
         This method will collect all the data from the specified folder.
+        If the data of the folder were collected and mapped before (see sic_mapping),
+        they are read from the parquet cache instead, unless rebuild is True or the
+        source files were changed since (see __source_of).
         '''
         if not self.folder:
             print("Please specify a folder")
@@ -127,29 +445,60 @@ class Processor():
         elif self.folder[:2] not in ["85", "90", "95"]:
             print("Destined year not yet finished.")
             return
-        
-        print(f'\nStart collection data from folder "{self.folder}"...')
+
         path = getcwd() + self.__slash_maker() # it assumes the code file is in the same path as the overall data folder
 
         # list all the files without extension (since the data are the files without extensions)
         target_files = [f for f in listdir(path) if isfile(join(path, f)) and "." not in f]
-        data_out = self.__data # initiate data_out
+        source = self.__source_of(path, target_files)
 
-        for cur_file in target_files:
-            with open(join(path, cur_file), 'rb') as f:
-                text = f.read()
-                text = text.decode('ascii', 'ignore') # there are some bytes not encoded as ascii...
-                companies_raw = text.split("\r\n") # 'rb' => "\r\n"; 'r' => "\n"
+        if not rebuild and self.__data is None and self.__read_cache(source):
+            self._extracted = True
+            self.__source = None # already cached
+            return
 
-                # I found there is an empty element in the end, currently simply remove the last one.
-                # TODO: might want to remove all empty from the back.
-                companies_raw = companies_raw[:-1]
+        print(f'\nStart collection data from folder "{self.folder}"...')
 
-                # default axis=0, meaning we are stacking the data for both DataFrame and Series.
-                data_out = pd.concat([data_out, self._extract(companies_raw)]).reset_index(drop=True)
+        # count the companies first, so the columns are allocated only once and each
+        # file is put right after the former file, no stacking needed.
+        sizes = [self.__n_records(join(path, f)) for f in target_files]
+        columns = {col: np.empty(sum(sizes), dtype=dtype) for col, dtype in COLUMNS.items()}
+        offset = 0
+
+        # the files are independent of each other, so they are parsed in parallel processes.
+        # (map gives the results in the order of the files)
+        # each worker already takes a core, so its numba kernel runs on a single thread,
+        # and no more workers than files are started.
+        n_workers = max(1, min(len(target_files), cpu_count() or 1))
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=set_num_threads, initargs=(1,)) as executor:
+            parts = executor.map(Processor._parse_file, [join(path, f) for f in target_files],
+                                 repeat(self.folder[:2]), sizes)
+
+            for cur_file, n, part in zip(target_files, sizes, parts):
+                for col, arr in columns.items():
+                    arr[offset:offset+n] = part[col]
+                offset += n
                 print(f"File {cur_file} finished.")
 
-        data_out.columns = ['scale', 'primary', 'roc_sic', 'asset']
+        # build from the 1-D columns without copying, so each column keeps its own
+        # contiguous buffer (no 2-D block to be reduced along a strided axis).
+        data_out = pd.DataFrame({
+            'scale': self.__to_category(columns['scale']),
+            'primary': self.__to_text(columns['primary']),
+            'roc_sic': self.__to_category(columns['roc_sic']),
+            'asset': columns['asset']
+        }, copy=False)
+
+        # only the data of a single fresh collection are cached, not the stacked ones.
+        self.__source = source if self.__data is None else None
+
+        if self.__data is not None:
+            # default axis=0, meaning we are stacking the data for both DataFrame and Series.
+            data_out = pd.concat([self.__conditioned_data(), data_out], ignore_index=True)
+            # stacking categories of different values gives strings, turn them back.
+            for col in ['scale', 'roc_sic']:
+                data_out[col] = data_out[col].astype('category')
+            self.__mask = None
 
         self._extracted = True
         self.__data = data_out
@@ -157,20 +506,36 @@ class Processor():
 
         return
 
+    def __conditioned_data(self) -> pd.DataFrame:
+        '''
+        Return
+        ------
+            the data with only the rows kept by the applied conditions.
+        '''
+        if self.__mask is None:
+            return self.__data
+
+        return self.__data[self.__mask].reset_index(drop=True)
+
     def apply_conditions(self, keep_original_data=False, **conds) -> None:
+        '''
+        The conditions are stored as a mask of the rows to keep rather than copying
+        the data, and are applied when the data is used (e.g. some_analysis, get_data).
+        So the original data is always kept, regardless of keep_original_data.
+        '''
         if not self._extracted:
             print(self.__warn_data_not_collected)
             return
-        
-        if keep_original_data:
-            # make a copy
-            # self.__data_origin = self.__data
-            pass
 
         # TODO: still thinking how to automatically apply conditions. Currently manual.
-        cond1 = (self.__data['scale'] != "8")
+        # scale is a category, so compare its int codes rather than the strings.
+        scale = self.__data['scale'].cat
+        if "8" in scale.categories:
+            cond1 = scale.codes.to_numpy() != scale.categories.get_loc("8")
+        else:
+            cond1 = np.ones(len(self.__data), dtype=bool)
 
-        self.__data = self.__data[cond1].reset_index(drop=True)
+        self.__mask = cond1 if self.__mask is None else (self.__mask & cond1)
 
     def sic_mapping(self) -> None:
         '''
@@ -178,13 +543,16 @@ class Processor():
         Notice that the mapping is hard-coded, ROC year 85: ROCSIC6 etc, 
 
         Will add a new column named "isic" after this method was called.
+        The collected data with "isic" are then saved as the parquet cache for the next run
+        (only for a single fresh collection, not for stacked or cached data), scale, roc_sic
+        and isic are categories, so they are stored dictionary encoded.
         '''
         if not self._extracted:
             print(self.__warn_data_not_collected)
             return  
 
         # read the mapping table in
-        sic_tb = pd.read_excel("ISIC_to_ROCSIC.xlsx", sheet_name="Sheet2")
+        sic_tb = _load_sic_table()
 
         # force all elements as string, so that latter when splitting won't 
         # turn single int into NaN
@@ -197,20 +565,34 @@ class Processor():
         
         # make the mapping with ROCSIC as key (in the table read in, ISIC is the key)
         # TODO: 不知道有沒有更好的辦法來對應這種數字但有可能變成前面帶0的文字
-        rocsic_to_isic = {}
-        code_using = code_using.str.split(",")
-        for i in range(sic_tb.shape[0]):
-            for k in code_using[i]:
-                if k.isnumeric() and int(k) < 10:
-                    k = "0" + k
-                rocsic_to_isic[k] = sic_tb['ISIC_Rev3'][i]
+        # one row per ROCSIC code, and the single digit codes are padded with a 0 in front.
+        codes = sic_tb[['ISIC_Rev3']].assign(code=code_using.str.split(",")).explode('code')
+        codes['code'] = codes['code'].str.strip()
+        single_digit = codes['code'].str.fullmatch(r'\d')
+        codes.loc[single_digit, 'code'] = "0" + codes.loc[single_digit, 'code']
+        rocsic_to_isic = dict(zip(codes['code'], codes['ISIC_Rev3']))
 
         # print(rocsic_to_isic) # for checking the mapping result.
-        self.__data['isic'] = self.__data['roc_sic'].map(rocsic_to_isic).fillna(rocsic_to_isic['Else'])
+        # roc_sic is a category, so only its (few) categories need to be mapped, then the
+        # isic category code of each company is gathered by its roc_sic category code.
+        roc_sic = self.__data['roc_sic'].cat
+        isic_of_roc = pd.Categorical([rocsic_to_isic.get(k, rocsic_to_isic['Else']) for k in roc_sic.categories])
+        self.__data['isic'] = pd.Categorical.from_codes(isic_of_roc.codes[roc_sic.codes.to_numpy()],
+                                                        categories=isic_of_roc.categories)
+
+        if self.__source is not None:
+            self.__write_cache()
 
     def some_analysis(self) -> None:
-        by_rocsic = self.__data.groupby(['roc_sic'])['asset'].sum().reset_index()
-        by_isic = self.__data.groupby(['isic'])['asset'].sum().reset_index()
+        data = self.__data
+        if self.__mask is not None:
+            data = data.loc[self.__mask, ['roc_sic', 'isic', 'asset']]
+
+        # each roc_sic maps to only one isic, so summing by both in one pass and then
+        # adding up the (small) result gives the sums by either of them.
+        by_both = data.groupby(['roc_sic', 'isic'], observed=True)['asset'].sum()
+        by_rocsic = by_both.groupby(level='roc_sic', observed=True).sum().reset_index()
+        by_isic = by_both.groupby(level='isic', observed=True).sum().reset_index()
 
         print(by_isic)
         # by_rocsic.to_csv(f'{self.folder[:3]}_groupby_rocsic_asset.csv', index=False)
@@ -220,29 +602,35 @@ class Processor():
         if not self._extracted:
             print(self.__warn_data_not_collected)
             return
-        print(self.__data)
+        print(self.__conditioned_data())
 
     def get_data(self) -> pd.DataFrame:
         if not self._extracted:
             print(self.__warn_data_not_collected)
+            return self.__data
 
-        return self.__data
+        return self.__conditioned_data()
     
     def output_CSV(self) -> None:
         if not self._extracted:
             print(self.__warn_data_not_collected)
         
-        self.__data.to_csv(f'{self.folder[:3]}_extracted.csv', index=False)
+        self.__conditioned_data().to_csv(f'{self.folder[:3]}_extracted.csv', index=False)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Extract and analyze the industrial census data.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="collect the data from the raw files again, instead of the parquet cache.")
+    args = parser.parse_args()
+
     path = "" # 想一下要不要改成程式不管放哪都可以透過這個path抓資料
     folders = ["85年AA290005", "90年AA290006", "95年AA290007"]
     # folders = [folders[2]]
 
     for folder in folders:
         p = Processor(upperlayer_folder="工商普查原始", folder=folder)
-        p.collect_data()
+        p.collect_data(rebuild=args.rebuild)
         p.sic_mapping()
 
         conds = {